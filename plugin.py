@@ -1,175 +1,137 @@
 from opencopilot.controller.operators_executor import OperatorExecutor
 from opencopilot.utils import logger
 import asyncio
-from typing import Optional
+import atexit
+import builtins
+import logging
+import threading
 from dotenv import load_dotenv
+import importlib
+import importlib.metadata
+import importlib.util
 import subprocess
 import sys
 import os
 import json
+import re
+import time
+import codecs
+from collections import OrderedDict, deque
+from types import MappingProxyType
 
-load_dotenv()
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# Global conversation history storage (keyed by session_id)
-_conversation_history = {}
+# Load .env only once per process tree; re-imports and child workers inherit the flag
+if not os.environ.get("_PLUGIN_DOTENV_LOADED"):
+    load_dotenv()
+    os.environ["_PLUGIN_DOTENV_LOADED"] = "1"
 
 
-class IncortaMCPExecutor(OperatorExecutor):
-    def execute(self, task_context, operator):
-        """
-        Main execution method called by Incorta Copilot.
-        Installs dependencies and runs the async MCP client.
-        """
-        install_or_upgrade_packages()
+class _LRUCache(OrderedDict):
+    """Dictionary that evicts its least recently used entry once it holds more than maxsize keys."""
 
-        try:
-            result = asyncio.run(self._async_execute(task_context, operator))
-        except Exception as e:
-            logger.error(f"Error in execute: {str(e)}")
-            result = f"Error: {str(e)}"
-        
-        self.finalize(task_context, result)
-    
-    async def _async_execute(self, task_context, operator):
-        """
-        Async execution that initializes MCP client and runs the agent.
-        
-        This operator can be called multiple times with different operator_renderer values:
-        - First call (Task 1): operator_renderer = "MarkdownRenderer" → Generate full analysis
-        - Second call (Task 2): operator_renderer = "HtmlRenderer" → Extract/generate HTML dashboard
-        """
-        from langchain_mcp_adapters.client import MultiServerMCPClient
-        from langgraph.prebuilt import create_react_agent
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
 
-        try:
-            # Check which task we are (based on task_context.task_index)
-            current_task_id = task_context.tasks[task_context.task_index]["id"]
-            logger.info(f"Executing task {current_task_id}")
-            
-            # Task 2 should check if Task 1 has already done the work
-            if current_task_id == 2:
-                logger.info("=== TASK 2 EXECUTION START ===")
-                # This is the HtmlRenderer task - check if we can reuse Task 1's result
-                first_task = next((t for t in task_context.tasks if t["id"] == 1 and t.get("status") == "DONE"), None)
-                
-                if first_task:
-                    logger.info(f"Task 1 found with status: {first_task.get('status')}")
-                    logger.info(f"Task 1 has result: {first_task.get('result') is not None}")
-                else:
-                    logger.warning("Task 1 not found or not DONE yet!")
-                
-                if first_task and first_task.get("result"):
-                    logger.info("Task 2: Reusing Task 1's result to extract HTML")
-                    # Extract HTML from Task 1's markdown result
-                    markdown_result = first_task["result"]
-                    logger.info(f"Task 1 result length: {len(str(markdown_result))} characters")
-                    html_dashboard = self.extract_html_dashboard(markdown_result)
-                    
-                    if html_dashboard:
-                        logger.info(f"HTML dashboard extracted, length: {len(html_dashboard)} characters")
-                        # Return HtmlOutput format as specified in docs Section 5
-                        # For final task result (not intermediate output)
-                        return {
-                            "content": html_dashboard,
-                            "aspect_ratio": "16/9",
-                            "title": "Interactive Dashboard",
-                            "html_type": "dashboard"
-                            # Note: NO "type" field for final task results
-                        }
-                    else:
-                        # no html, then return none 
-                        logger.info("Task 2: No HTML dashboard found in Task 1's result")
-                        return None
-                else:
-                    logger.error("Task 2: Cannot access Task 1 result - falling through to re-execute!")
-                    # Don't re-execute, return none
-                    return None
-            
-            # operator or task  1: do the main work (query MCP, generate response, even the report)
-            logger.info(f"Task {current_task_id}: Starting MCP agent execution")
-            
-            # Update progress for user visibility
-            task_context.update_short_description_and_progress("Initializing MCP connection...")
-            
-            # Get user session information
-            user_info = self._get_user_session_info(task_context)
-            logger.info(f"User session info: {user_info}")
-            
-            # Get linked_schema from operator metadata
-            linked_schema = self._get_linked_schema(task_context, operator)
-            logger.info(f"Using linked_schema: {linked_schema}")
-            
-            # Get uploaded files if any
-            uploaded_files = task_context.get_selected_uploaded_file_paths()
-            if uploaded_files:
-                logger.info(f"Found {len(uploaded_files)} uploaded file(s): {uploaded_files}")
-                # Read file contents and add to context
-                file_contents = self._read_uploaded_files(uploaded_files)
-            else:
-                logger.info("No uploaded files found")
-                file_contents = None
-            
-            # --- private mcp ------
-            headers = {}
-            if user_info.get("incorta_url"):
-                headers["env-url"] = user_info["incorta_url"]
-            if user_info.get("tenant"):
-                headers["tenant"] = user_info["tenant"]
-            if user_info.get("username"):
-                headers["user"] = user_info["username"]  
-            if user_info.get("password"):
-                headers["password"] = user_info["password"]  
-            
-            logger.info(f"MCP headers configured: {list(headers.keys())}")
-            
-            # Initialize MCP client with user's credentials
-            client = MultiServerMCPClient(
-                {
-                    "Incorta MCP Server": {
-                        "url": user_info.get("mcp_server_url", "https://alone-recall-wait-era.trycloudflare.com/mcp/"),
-                        "headers": headers,
-                        "transport": "streamable_http",
-                    }
-                }
-            )
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
 
-            # Get tools from MCP server
-            task_context.update_short_description_and_progress("Retrieving available tools...")
-            tools = await client.get_tools()
-            logger.info(f"Retrieved {len(tools)} tools from MCP server")
+    def get(self, key, default=None):
+        return self[key] if key in self else default
 
-            # Initialize LLM
-            task_context.update_short_description_and_progress("Initializing AI agent...")
-            # API key should be provided via environment variable ANTHROPIC_API_KEY
-            # or through CMC configuration
-            llm = self.create_llm(
-                "anthropic",
-                model="claude-sonnet-4-20250514"  # Updated to Sonnet 4.5 (latest stable)
-            )
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
 
-            # Create agent with tools
-            agent = create_react_agent(model=llm, tools=tools)
 
-            # Get or create conversation history for this session
-            session_id = user_info.get('session_id', 'default')
-            if session_id not in _conversation_history:
-                _conversation_history[session_id] = []
-                logger.info(f"Created new conversation history for session {session_id}")
-            else:
-                logger.info(f"Reusing conversation history for session {session_id} ({len(_conversation_history[session_id])} messages)")
-            
-            # Use the session's conversation history
-            messages = _conversation_history[session_id].copy()
-            
-            # only add system prompt if it's not already in history
-            # This prevents cache invalidation and enables proper prompt caching
-            has_system_prompt = any(msg.get("role") == "system" for msg in messages)
-            
-            if not has_system_prompt:
-                logger.info("Adding system prompt (first message in conversation)")
-                # Add main system prompt with dashboard generation instructions
-                # This will be cached using prompt caching to improve rate limits
-                system_prompt = """You are an expert Incorta data analyst assistant. Your primary role is to help users interact with their Incorta data using the Model Context Protocol (MCP) tools.
+# Global conversation history storage (keyed by session_id).
+# Only the _MAX_SESSIONS most recently used sessions are kept, and each session's history is a
+# deque holding its last _MAX_HISTORY_TURNS turns (the system prompt is added per turn).
+# A turn is a tuple of (optional file context, user, assistant) messages and is trimmed as a whole,
+# so the history never starts with an orphaned assistant reply or file context.
+# Access is guarded by _conversation_lock since execute() may be called from several threads.
+_MAX_SESSIONS = 1024
+_MAX_HISTORY_TURNS = 20
+_conversation_history = _LRUCache(maxsize=_MAX_SESSIONS)
+_conversation_lock = threading.Lock()
+
+# Separator line used when formatting uploaded file contents
+_SEP = "=" * 50
+
+# Required packages as (pip requirement, importable module name) pairs
+_REQUIRED_PACKAGES = [
+    ("mcp", "mcp"),
+    ("anthropic", "anthropic"),
+    ("langchain-core==0.3.75", "langchain_core"),
+    ("langchain==0.3.27", "langchain"),
+    ("langchain-anthropic==0.3.19", "langchain_anthropic"),
+    ("langchain-mistralai==0.2.11", "langchain_mistralai"),
+    ("langchain-openai==0.3.32", "langchain_openai"),
+    ("langchain-community==0.3.29", "langchain_community"),
+    ("langchain-google-genai==2.1.10", "langchain_google_genai"),
+    ("langgraph==0.2.60", "langgraph"),
+    ("langchain-mcp-adapters==0.1.9", "langchain_mcp_adapters"),
+    ("markdown", "markdown"),
+]
+
+# Number of trailing pip output lines kept for error reporting
+_PIP_LOG_TAIL_LINES = 50
+
+# Sentinel written once dependencies are known to be satisfied, so restarts skip the version check
+_DEPS_SENTINEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".deps_installed")
+_DEPS_INSTALLED = False
+
+# Long-lived event loop shared by all executions (runs in a daemon thread)
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+# MCP clients and their tool lists, keyed by (mcp_server_url, headers); values are (client, tools, expiry).
+# Only the _MAX_MCP_CLIENTS most recently used keys are kept; a build lock lives only while a client is built.
+_MAX_MCP_CLIENTS = 64
+_MCP_CLIENT_CACHE = _LRUCache(maxsize=_MAX_MCP_CLIENTS)
+_MCP_CLIENT_LOCKS = {}
+_MCP_CLIENT_TTL = 300  # seconds
+
+# Exception types that mean the MCP connection itself failed, resolved on first use (see _get_mcp_transport_errors)
+_mcp_transport_errors = None
+# Exception groups only exist from Python 3.11; None on older interpreters
+_BaseExceptionGroup = getattr(builtins, "BaseExceptionGroup", None)
+
+# Fallback session values used when the task context does not provide them (read-only)
+_DEFAULT_USER_INFO = MappingProxyType({
+    'username': 'admin',
+    'tenant': 'demo',
+    'password': 'Incorta_1234%',
+    'incorta_url': 'https://se-prod-demo.cloud4.incorta.com/incorta',
+    'mcp_server_url': 'https://alone-recall-wait-era.trycloudflare.com/mcp/'
+})
+
+# Separator runs that PEP 503 treats as equivalent in distribution names
+_PACKAGE_NAME_SEP_RE = re.compile(r"[-_.]+")
+
+# Tool results longer than this are shown truncated instead of pretty-printed
+_TOOL_RESULT_PREVIEW_CHARS = 500
+
+# Host module holding the operator registry, imported on first use (see _get_ext_ops)
+_ext_ops_module = None
+
+# markdown module, imported on first use (see _get_markdown); False if it is not installed
+_markdown_mod = None
+
+# Extra headers sent with every Anthropic request (enables prompt caching support)
+_ANTHROPIC_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+# Main system prompt with dashboard generation instructions.
+# Built once at import; it is cached server-side using prompt caching to improve rate limits
+_SYSTEM_PROMPT = """You are an expert Incorta data analyst assistant. Your primary role is to help users interact with their Incorta data using the Model Context Protocol (MCP) tools.
 
 **YOUR CORE CAPABILITIES:**
 
@@ -190,12 +152,6 @@ You have access to powerful Incorta MCP tools that allow you to:
 
 As an additional feature, you can present your analysis results as interactive HTML dashboards when appropriate.
 
-**When to use visualizations:**
-
-**VISUALIZATION CAPABILITY (OPTIONAL FEATURE):**
-
-As an additional feature, you can present your analysis results as interactive HTML dashboards when appropriate.
-
 **When to use visualizations:**
 - User explicitly requests a "dashboard", "chart", "graph", or "visualization"
 - You're presenting multi-metric analysis that would be clearer visually
@@ -395,21 +351,478 @@ When creating dashboards, wrap your HTML in a ```html code block with this exact
 
 **REMEMBER:**
 Your primary job is to help users access and understand their Incorta data using MCP tools. Dashboards are a helpful presentation tool, but most interactions will be standard Q&A about data, running queries, and providing insights in text/markdown format."""
+
+
+def _system_message():
+    """Build a fresh system message; only the (immutable) prompt text is shared between turns."""
+    return {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": _SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}  # Cache this system prompt
+            }
+        ]
+    }
+
+
+def _json_dumps(obj) -> str:
+    """Serialize obj for logging, using orjson when available (non-JSON values fall back to str)."""
+    try:
+        if orjson is not None:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        return json.dumps(obj, default=str)
+    except (TypeError, ValueError):
+        return repr(obj)
+
+
+def _get_ext_ops():
+    """
+    Return the host's ext_op_functions registry (raises ImportError if unavailable).
+
+    Only the module import is cached. The registry attribute is read on every call, so a
+    registry the host rebinds or reloads is picked up just as an in-place edit is.
+    """
+    global _ext_ops_module
+    if _ext_ops_module is None:
+        _ext_ops_module = importlib.import_module("service_data.user_operators.operators")
+    try:
+        return _ext_ops_module.ext_op_functions
+    except AttributeError as e:
+        # Same error as the `from ... import ext_op_functions` this replaces
+        raise ImportError("cannot import name 'ext_op_functions'") from e
+
+
+def _get_markdown():
+    """
+    Return the markdown module, or None if it is not installed.
+
+    Resolved once on first use rather than at import time, because dependencies are only
+    installed when the first task executes.
+    """
+    global _markdown_mod
+    if _markdown_mod is None:
+        try:
+            import markdown
+            _markdown_mod = markdown
+        except ImportError:
+            _markdown_mod = False
+    return _markdown_mod or None
+
+
+def _linked_schema_for(op_name):
+    """Return the linked_schema configured for an operator, or None."""
+    return _get_ext_ops().get(op_name, {}).get("linked_schema", None)
+
+
+def _executor_args_for(op_name):
+    """Return the executor_args configured for an operator (treat as read-only)."""
+    return _get_ext_ops().get(op_name, {}).get("executor_args", {})
+
+
+def _get_mcp_transport_errors():
+    """
+    Return the tuple of exception types that indicate a broken MCP connection.
+
+    Resolved once on first use rather than at import time, because httpx and mcp are only
+    installed when the first task executes.
+    """
+    global _mcp_transport_errors
+    if _mcp_transport_errors is None:
+        # OSError covers ConnectionError; asyncio.TimeoutError is only an OSError from Python 3.11
+        errors = [OSError, asyncio.TimeoutError]
+        try:
+            import httpx
+            errors.append(httpx.HTTPError)
+        except ImportError:
+            pass
+        try:
+            from mcp.shared.exceptions import McpError
+            errors.append(McpError)
+        except ImportError:
+            pass
+        _mcp_transport_errors = tuple(errors)
+    return _mcp_transport_errors
+
+
+def _is_mcp_transport_error(exc):
+    """True if exc, or any exception in it when it is an exception group, is an MCP transport error."""
+    errors = _get_mcp_transport_errors()
+    if isinstance(exc, errors):
+        return True
+    # The streamable HTTP transport runs in a task group, so failures may arrive wrapped
+    return (
+        _BaseExceptionGroup is not None
+        and isinstance(exc, _BaseExceptionGroup)
+        and exc.subgroup(errors) is not None
+    )
+
+
+def _find_html_block(text, start=0):
+    """
+    Locate the first ```html fenced block at or after start with plain str.find scans.
+
+    Matches exactly what the regex r'```html\s*\n(.*?)\n```' (DOTALL, IGNORECASE) matches:
+    case-insensitive fence tag, whitespace containing a newline, body up to the next "\n```".
+    Runs in linear time, with no regex backtracking on adversarial input.
+    Returns (block_start, body_start, body_end, block_end) or None.
+    """
+    n = len(text)
+    pos = start
+    # Once no closing fence exists after some position, none exists after any later one
+    no_close_from = n + 1
+    while True:
+        fence = text.find("```", pos)
+        if fence == -1:
+            return None
+        pos = fence + 1
+        if text[fence + 3:fence + 7].lower() != "html":
+            continue
+
+        # The tag must be followed by whitespace that contains at least one newline;
+        # the body starts after the last newline of that run
+        ws_end = fence + 7
+        while ws_end < n and text[ws_end].isspace():
+            ws_end += 1
+        last_nl = text.rfind("\n", fence + 7, ws_end)
+        if last_nl == -1:
+            continue
+
+        body_end = -1 if last_nl + 1 >= no_close_from else text.find("\n```", last_nl + 1)
+        if body_end != -1:
+            return fence, last_nl + 1, body_end, body_end + 4
+        no_close_from = min(no_close_from, last_nl + 1)
+
+        # The whitespace run itself may end with the closing fence ("```html\n \n```"),
+        # in which case the (blank) body starts after the previous newline
+        if ws_end == last_nl + 1 and text.startswith("```", ws_end):
+            prev_nl = text.rfind("\n", fence + 7, last_nl)
+            if prev_nl != -1:
+                return fence, prev_nl + 1, last_nl, last_nl + 4
+
+
+def _repr_exceeds(args, limit):
+    """
+    Cheaply tell whether repr(args) of a dict would be longer than limit.
+
+    String values are measured by length instead of being rendered, other values are
+    rendered one at a time, and the scan stops as soon as the limit is crossed.
+    """
+    # Each item adds its key quotes, ": " and a ", " separator; for a non-empty dict the
+    # two braces cancel out the separator that the first item does not have
+    total = 0 if args else 2
+    for key, value in args.items():
+        total += len(str(key)) + 6
+        if total > limit:
+            return True
+        total += len(value) + 2 if isinstance(value, str) else len(repr(value))
+        if total > limit:
+            return True
+    return False
+
+
+def _get_loop():
+    """Return the background event loop, starting it on first use."""
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="incorta-mcp-loop", daemon=True
+            )
+            thread.start()
+            atexit.register(_stop_loop, loop, thread)
+            _LOOP = loop
+        return _LOOP
+
+
+def _stop_loop(loop, thread):
+    """Stop the background event loop at interpreter exit."""
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+
+
+def _run_coroutine(coro):
+    """
+    Run a coroutine on the background event loop and block until it finishes.
+
+    Works whether or not the calling thread is itself running an event loop (e.g. when the
+    host framework calls execute() from async code): the coroutine never runs nested on the
+    caller's loop. Only a call from the background loop's own thread is rejected, since
+    blocking there would deadlock.
+    """
+    loop = _get_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+
+    if running_loop is loop:
+        coro.close()
+        raise RuntimeError("execute() cannot be called from the plugin's own event loop")
+
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+async def _get_mcp_tools(cache_key, mcp_server_url, headers):
+    """
+    Return (client, tools) for an MCP server, reusing a cached client while it is fresh.
+
+    Only one coroutine per key builds a client on a cold cache; the others wait for it.
+    Expired entries are dropped when they are looked up.
+    """
+    from langchain_mcp_adapters.client import MultiServerMCPClient
+
+    def fresh_entry():
+        cached = _MCP_CLIENT_CACHE.get(cache_key)
+        if cached is None:
+            return None
+        if time.monotonic() < cached[2]:
+            return cached
+        del _MCP_CLIENT_CACHE[cache_key]
+        return None
+
+    cached = fresh_entry()
+    if cached:
+        return cached[0], cached[1]
+
+    lock = _MCP_CLIENT_LOCKS.setdefault(cache_key, asyncio.Lock())
+    try:
+        async with lock:
+            cached = fresh_entry()
+            if cached:
+                return cached[0], cached[1]
+
+            client = MultiServerMCPClient(
+                {
+                    "Incorta MCP Server": {
+                        "url": mcp_server_url,
+                        "headers": headers,
+                        "transport": "streamable_http",
+                    }
+                }
+            )
+            tools = await client.get_tools()
+            _MCP_CLIENT_CACHE[cache_key] = (client, tools, time.monotonic() + _MCP_CLIENT_TTL)
+            return client, tools
+    finally:
+        # Waiters already hold a reference to the lock; later callers hit the cache first
+        if _MCP_CLIENT_LOCKS.get(cache_key) is lock:
+            del _MCP_CLIENT_LOCKS[cache_key]
+
+
+def _build_openai(**kwargs):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        base_url="https://api.together.xyz/v1",
+        model=kwargs.get("model", "gpt-4"),
+        api_key=kwargs.get("api_key"),
+        temperature=kwargs.get("temperature", 0.7)
+    )
+
+
+def _build_anthropic(**kwargs):
+    from langchain_anthropic import ChatAnthropic
+    return ChatAnthropic(
+        model=kwargs.get("model", "claude-sonnet-4-20250514"),
+        api_key=kwargs.get("api_key"),
+        temperature=kwargs.get("temperature", 0.7),
+        # Enable prompt caching support
+        default_headers=_ANTHROPIC_HEADERS,
+        max_tokens=kwargs.get("max_tokens", 8192)  # increased as generating html repotrts need a lot of tokens
+    )
+
+
+def _build_ollama(**kwargs):
+    from langchain_community.chat_models import ChatOllama
+    return ChatOllama(
+        model=kwargs.get("model", "llama2"),
+        base_url=kwargs.get("base_url", "http://localhost:11434"),
+        temperature=kwargs.get("temperature", 0.7)
+    )
+
+
+def _build_google(**kwargs):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model=kwargs.get("model", "gemini-2.5-flash-lite-preview-06-17"),
+        google_api_key=kwargs.get("api_key"),
+        temperature=kwargs.get("temperature", 0.7)
+    )
+
+
+def _build_mistral(**kwargs):
+    from langchain_mistralai import ChatMistralAI
+    return ChatMistralAI(
+        model=kwargs.get("model", "mistral-medium"),
+        mistral_api_key=kwargs.get("api_key"),
+        temperature=kwargs.get("temperature", 0.7)
+    )
+
+
+# LLM builders keyed by lowercase provider name; each imports only its own package
+_LLM_PROVIDERS = {
+    "openai": _build_openai,
+    "anthropic": _build_anthropic,
+    "ollama": _build_ollama,
+    "google": _build_google,
+    "mistral": _build_mistral,
+}
+
+
+class IncortaMCPExecutor(OperatorExecutor):
+    MAX_FILE_SIZE = 1_000_000  # 1 MB limit per uploaded file
+    MAX_PREVIEW_LINES = 100  # Show first 100 lines for large files
+    
+    def execute(self, task_context, operator):
+        """
+        Main execution method called by Incorta Copilot.
+        Installs missing dependencies (once per process) and runs the async MCP client.
+        """
+        global _DEPS_INSTALLED
+        if not _DEPS_INSTALLED:
+            _DEPS_INSTALLED = _ensure_deps()
+
+        try:
+            result = _run_coroutine(self._async_execute(task_context, operator))
+        except Exception as e:
+            logger.error(f"Error in execute: {str(e)}")
+            result = f"Error: {str(e)}"
+        
+        self.finalize(task_context, result)
+    
+    async def _async_execute(self, task_context, operator):
+        """
+        Async execution that initializes MCP client and runs the agent.
+        
+        This operator can be called multiple times with different operator_renderer values:
+        - First call (Task 1): operator_renderer = "MarkdownRenderer" → Generate full analysis
+        - Second call (Task 2): operator_renderer = "HtmlRenderer" → Extract/generate HTML dashboard
+        """
+        from langgraph.prebuilt import create_react_agent
+
+        try:
+            # Check which task we are (based on task_context.task_index)
+            current_task_id = task_context.tasks[task_context.task_index]["id"]
+            logger.info(f"Executing task {current_task_id}")
+            
+            # Task 2 should check if Task 1 has already done the work
+            if current_task_id == 2:
+                logger.info("=== TASK 2 EXECUTION START ===")
+                # This is the HtmlRenderer task - check if we can reuse Task 1's result
+                first_task = next((t for t in task_context.tasks if t["id"] == 1 and t.get("status") == "DONE"), None)
                 
-                # Add system message with cache control for prompt caching
-                #  reduces rate limit usage significantly for repeated prompts
-                messages.append({
-                    "role": "system", 
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": system_prompt,
-                            "cache_control": {"type": "ephemeral"}  # Cache this system prompt
+                if first_task:
+                    logger.info(f"Task 1 found with status: {first_task.get('status')}")
+                    logger.info(f"Task 1 has result: {first_task.get('result') is not None}")
+                else:
+                    logger.warning("Task 1 not found or not DONE yet!")
+                
+                if first_task and first_task.get("result"):
+                    logger.info("Task 2: Reusing Task 1's result to extract HTML")
+                    # Extract HTML from Task 1's markdown result
+                    markdown_result = first_task["result"]
+                    if logger.isEnabledFor(logging.DEBUG):
+                        # The result is normally the markdown string itself; only other types need str()
+                        result_text = markdown_result if isinstance(markdown_result, str) else str(markdown_result)
+                        logger.debug("Task 1 result length: %d characters", len(result_text))
+                    html_dashboard = self.extract_html_dashboard(markdown_result)
+                    
+                    if html_dashboard:
+                        logger.info(f"HTML dashboard extracted, length: {len(html_dashboard)} characters")
+                        # Return HtmlOutput format as specified in docs Section 5
+                        # For final task result (not intermediate output)
+                        return {
+                            "content": html_dashboard,
+                            "aspect_ratio": "16/9",
+                            "title": "Interactive Dashboard",
+                            "html_type": "dashboard"
+                            # Note: NO "type" field for final task results
                         }
-                    ]
-                })
+                    else:
+                        # no html, then return none 
+                        logger.info("Task 2: No HTML dashboard found in Task 1's result")
+                        return None
+                else:
+                    logger.error("Task 2: Cannot access Task 1 result - falling through to re-execute!")
+                    # Don't re-execute, return none
+                    return None
+            
+            # operator or task  1: do the main work (query MCP, generate response, even the report)
+            logger.info(f"Task {current_task_id}: Starting MCP agent execution")
+            
+            # Update progress for user visibility
+            task_context.update_short_description_and_progress("Initializing MCP connection...")
+            
+            # Get user session information
+            user_info = self._get_user_session_info(task_context)
+            logger.debug("User session info: %s", user_info)
+            
+            # Get linked_schema from operator metadata
+            linked_schema = self._get_linked_schema(task_context, operator)
+            logger.info("Using linked_schema: %s", linked_schema)
+            
+            # Get uploaded files if any
+            uploaded_files = task_context.get_selected_uploaded_file_paths()
+            if uploaded_files:
+                logger.info(f"Found {len(uploaded_files)} uploaded file(s): {uploaded_files}")
+                # Read file contents and add to context
+                file_contents = await self._read_uploaded_files_async(uploaded_files)
+            else:
+                logger.info("No uploaded files found")
+                file_contents = None
+            
+            # --- private mcp ------
+            headers = {}
+            if user_info.get("incorta_url"):
+                headers["env-url"] = user_info["incorta_url"]
+            if user_info.get("tenant"):
+                headers["tenant"] = user_info["tenant"]
+            if user_info.get("username"):
+                headers["user"] = user_info["username"]  
+            if user_info.get("password"):
+                headers["password"] = user_info["password"]  
+            
+            logger.info(f"MCP headers configured: {list(headers.keys())}")
+            
+            # Get MCP client and tools for the user's credentials (cached per server + credentials)
+            mcp_server_url = user_info.get("mcp_server_url", _DEFAULT_USER_INFO["mcp_server_url"])
+            cache_key = (mcp_server_url, tuple(sorted(headers.items())))
+            task_context.update_short_description_and_progress("Retrieving available tools...")
+            client, tools = await _get_mcp_tools(cache_key, mcp_server_url, headers)
+            logger.info(f"Retrieved {len(tools)} tools from MCP server")
+
+            # Initialize LLM
+            task_context.update_short_description_and_progress("Initializing AI agent...")
+            # API key should be provided via environment variable ANTHROPIC_API_KEY
+            # or through CMC configuration
+            llm = self.create_llm(
+                "anthropic",
+                model="claude-sonnet-4-20250514"  # Updated to Sonnet 4.5 (latest stable)
+            )
+
+            # Create agent with tools
+            agent = create_react_agent(model=llm, tools=tools)
+
+            # Get or create conversation history for this session
+            session_id = user_info.get('session_id', 'default')
+            with _conversation_lock:
+                history = _conversation_history.get(session_id)
+                is_new_session = history is None
+                if is_new_session:
+                    history = deque(maxlen=_MAX_HISTORY_TURNS)
+                    _conversation_history[session_id] = history
+
+                # The system prompt is not stored in the history; it is sent first on every turn with
+                # identical content, which keeps the cached prompt prefix stable (enables cache hits).
+                # Invariant: messages[0] is always the system prompt, so no scan for it is needed.
+                messages = [_system_message(), *(message for turn in history for message in turn)]
+            if is_new_session:
+                logger.info(f"Created new conversation history for session {session_id}")
             else:
-                logger.info(f"System prompt already in history, reusing cached version (enables cache hits)")
+                logger.info(f"Reusing conversation history for session {session_id} ({len(messages) - 1} messages)")
+            new_messages_start = len(messages)
             
             # If files are uploaded, add their content to the initial context
             if file_contents:
@@ -421,16 +834,28 @@ Use this information along with the Incorta MCP tools to answer the user's quest
                 messages.append({"role": "system", "content": file_context})
             
             task_context.update_short_description_and_progress("Analyzing your query...")
-            final_response = await self.handle_user_message(
-                agent,
-                messages,
-                task_context.user_query_str,
-                task_context
-            )
+            try:
+                final_response = await self.handle_user_message(
+                    agent,
+                    messages,
+                    task_context.user_query_str,
+                    task_context
+                )
+            except Exception as e:
+                # On a connection failure, drop the cached client so the next call reconnects
+                # and re-lists tools; other errors (LLM, rate limits, bad input) keep it.
+                # Failures inside a tool call never get here: langgraph's ToolNode handles tool
+                # errors by default and returns them to the model as error ToolMessages, so this
+                # only catches a broken connection that escapes the agent itself. Otherwise the
+                # cached entry is refreshed when its TTL runs out.
+                if _is_mcp_transport_error(e):
+                    _MCP_CLIENT_CACHE.pop(cache_key, None)
+                raise
 
-            # Save updated conversation history back to global storage
-            _conversation_history[session_id] = messages
-            logger.info(f"Saved conversation history ({len(messages)} messages)")
+            # Append this turn to the session history; the deque drops the oldest turns itself
+            with _conversation_lock:
+                history.append(tuple(messages[new_messages_start:]))
+            logger.info(f"Saved conversation history ({len(history)} turns)")
 
             task_context.update_short_description_and_progress("Analysis complete")
             
@@ -457,12 +882,8 @@ Use this information along with the Incorta MCP tools to answer the user's quest
             The linked schema name or None if not found
         """
         try:
-            from service_data.user_operators.operators import ext_op_functions
-            
             op_name = task_context.tasks[task_context.task_index]["operator"]
-            linked_schema = ext_op_functions.get(op_name, {}).get("linked_schema", None)
-            
-            return linked_schema
+            return _linked_schema_for(op_name)
         except ImportError:
             logger.warning("Could not import ext_op_functions, linked_schema not available")
             return None
@@ -480,7 +901,8 @@ Use this information along with the Incorta MCP tools to answer the user's quest
         Returns:
             Dictionary containing user session info
         """
-        user_info = {}
+        # Start from the defaults and only overwrite what the task context provides
+        user_info = dict(_DEFAULT_USER_INFO)
         
         try:
             # Get user session ID
@@ -490,43 +912,32 @@ Use this information along with the Incorta MCP tools to answer the user's quest
             # Get user information
             if hasattr(task_context, 'user_context'):
                 user_context = task_context.user_context
-                logger.info(f"DEBUG: user_context keys available: {list(user_context.keys()) if isinstance(user_context, dict) else 'not a dict'}")
-                logger.info(f"DEBUG: user_context content: {user_context}")
-                user_info['username'] = user_context.get('user', 'admin')
-                user_info['tenant'] = user_context.get('tenant', 'demo')
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("DEBUG: user_context keys available: %s", list(user_context.keys()) if isinstance(user_context, dict) else 'not a dict')
+                    logger.debug("DEBUG: user_context content: %s", _json_dumps(user_context))
+                user_info['username'] = user_context.get('user', _DEFAULT_USER_INFO['username'])
+                user_info['tenant'] = user_context.get('tenant', _DEFAULT_USER_INFO['tenant'])
                 # Try to get password from user_context
-                user_info['password'] = user_context.get('password', 'Incorta_1234%')
-            else:
-                # Set defaults if user_context doesn't exist
-                user_info['username'] = 'admin'
-                user_info['tenant'] = 'demo'
-                user_info['password'] = 'Incorta_1234%'
+                user_info['password'] = user_context.get('password', _DEFAULT_USER_INFO['password'])
             
             # Get Incorta server URL from context
             if hasattr(task_context, 'server_context'):
                 server_context = task_context.server_context
-                logger.info(f"DEBUG: server_context keys available: {list(server_context.keys()) if isinstance(server_context, dict) else 'not a dict'}")
-                logger.info(f"DEBUG: server_context content: {server_context}")
-                user_info['incorta_url'] = server_context.get('server_url', 'https://se-prod-demo.cloud4.incorta.com/incorta')
-            else:
-                user_info['incorta_url'] = 'https://se-prod-demo.cloud4.incorta.com/incorta'
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("DEBUG: server_context keys available: %s", list(server_context.keys()) if isinstance(server_context, dict) else 'not a dict')
+                    logger.debug("DEBUG: server_context content: %s", _json_dumps(server_context))
+                user_info['incorta_url'] = server_context.get('server_url', _DEFAULT_USER_INFO['incorta_url'])
             
             # Get MCP server URL from executor_args or use default
             executor_args = self._get_executor_args(task_context, None)
-            user_info['mcp_server_url'] = executor_args.get('mcp_server_url', 'https://alone-recall-wait-era.trycloudflare.com/mcp/')
+            user_info['mcp_server_url'] = executor_args.get('mcp_server_url', _DEFAULT_USER_INFO['mcp_server_url'])
             
             logger.info(f"Extracted user session info: session_id={user_info.get('session_id')}, username={user_info.get('username')}, tenant={user_info.get('tenant')}, has_password={user_info.get('password') is not None}")
             
         except Exception as e:
             logger.error(f"Error extracting user session info: {str(e)}")
             # Return defaults if extraction fails
-            user_info = {
-                'username': 'admin',
-                'tenant': 'demo',
-                'password': 'Incorta_1234%',
-                'incorta_url': 'https://se-prod-demo.cloud4.incorta.com/incorta',
-                'mcp_server_url': 'https://alone-recall-wait-era.trycloudflare.com/mcp/'
-            }
+            user_info = dict(_DEFAULT_USER_INFO)
         
         return user_info
     
@@ -542,12 +953,8 @@ Use this information along with the Incorta MCP tools to answer the user's quest
             Dictionary of executor arguments
         """
         try:
-            from service_data.user_operators.operators import ext_op_functions
-            
             op_name = task_context.tasks[task_context.task_index]["operator"]
-            executor_args = ext_op_functions.get(op_name, {}).get("executor_args", {})
-            
-            return executor_args
+            return _executor_args_for(op_name)
         except Exception as e:
             logger.error(f"Error retrieving executor_args: {str(e)}")
             return {}
@@ -562,120 +969,118 @@ Use this information along with the Incorta MCP tools to answer the user's quest
         Returns:
             String containing formatted file contents
         """
-        MAX_FILE_SIZE = 1_000_000  # 1 MB limit per file
-        MAX_PREVIEW_LINES = 100  # Show first 100 lines for large files
-        
-        contents = []
-        for file_path in file_paths:
-            try:
-                # Get filename from path
-                filename = os.path.basename(file_path)
-                file_size = os.path.getsize(file_path)
-                
-                # Try to read as text
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    if file_size > MAX_FILE_SIZE:
-                        # File is too large, read only preview
-                        lines = []
-                        for i, line in enumerate(f):
-                            if i >= MAX_PREVIEW_LINES:
-                                break
-                            lines.append(line)
-                        content = ''.join(lines)
-                        contents.append(
-                            f"File: {filename} ({file_size:,} bytes - showing first {MAX_PREVIEW_LINES} lines)\n"
-                            f"{'='*50}\n{content}\n"
-                            f"[... file continues for {file_size:,} total bytes ...]\n"
-                            f"{'='*50}\n"
-                        )
-                        logger.warning(f"File {filename} is large ({file_size:,} bytes), showing preview only")
-                    else:
-                        # File is small enough, read all
-                        content = f.read()
-                        contents.append(f"File: {filename}\n{'='*50}\n{content}\n{'='*50}\n")
-                        logger.info(f"Successfully read file: {filename} ({len(content)} characters)")
-                        
-            except UnicodeDecodeError:
-                # If it's a binary file, just note that
-                logger.warning(f"File {filename} appears to be binary, skipping content reading")
-                contents.append(f"File: {filename}\n{'='*50}\n[Binary file - content not displayed]\n{'='*50}\n")
-            except Exception as e:
-                logger.error(f"Error reading file {file_path}: {str(e)}")
-                contents.append(f"File: {filename}\n{'='*50}\n[Error reading file: {str(e)}]\n{'='*50}\n")
+        contents = [self._read_uploaded_file(file_path) for file_path in file_paths]
+        return "\n".join(contents) if contents else None
+    
+    async def _read_uploaded_files_async(self, file_paths):
+        """
+        Read contents of uploaded files concurrently, each in a worker thread.
         
+        Args:
+            file_paths: List of file paths to read
+            
+        Returns:
+            String containing formatted file contents (in the order of file_paths)
+        """
+        contents = await asyncio.gather(
+            *(asyncio.to_thread(self._read_uploaded_file, file_path) for file_path in file_paths)
+        )
         return "\n".join(contents) if contents else None
+    
+    def _read_uploaded_file(self, file_path):
+        """
+        Read a single uploaded file.
+        
+        Args:
+            file_path: Path of the file to read
+            
+        Returns:
+            String block with the formatted file contents (or a note if it could not be read)
+        """
+        try:
+            # Get filename from path
+            filename = os.path.basename(file_path)
+            
+            # Read raw bytes once (at most one byte past the limit) and decode in a single call
+            with open(file_path, 'rb') as f:
+                file_size = os.fstat(f.fileno()).st_size
+                data = f.read(self.MAX_FILE_SIZE + 1)
+            # Translate newlines the way text mode would ('\r\n' and '\r' become '\n')
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            
+            if file_size > self.MAX_FILE_SIZE:
+                # File is too large, keep only the preview lines (bounded by the bytes read)
+                pieces = data.split(b"\n", self.MAX_PREVIEW_LINES)
+                if len(pieces) > self.MAX_PREVIEW_LINES:
+                    # Every kept piece is a complete line; the dropped remainder is the rest of the file
+                    del pieces[self.MAX_PREVIEW_LINES:]
+                    preview = b"\n".join(pieces) + b"\n"
+                    shown = f"first {len(pieces)} lines"
+                else:
+                    # Fewer newlines than that within the bytes read: the last piece is where the
+                    # byte limit cut the file, so it is not counted as a line
+                    preview = b"\n".join(pieces)
+                    complete_lines = len(pieces) - 1
+                    if not pieces[-1]:
+                        shown = f"first {complete_lines} lines"
+                    elif complete_lines:
+                        shown = f"first {complete_lines} lines and part of the next"
+                    else:
+                        shown = "part of the first line"
+                # The byte limit may cut a multi-byte character in half; an incremental decoder
+                # drops that trailing fragment but still rejects invalid bytes (binary files)
+                content = codecs.getincrementaldecoder('utf-8')().decode(preview)
+                logger.warning(f"File {filename} is large ({file_size:,} bytes), showing preview only")
+                return (
+                    f"File: {filename} ({file_size:,} bytes - showing {shown})\n"
+                    f"{_SEP}\n{content}\n"
+                    f"[... file continues for {file_size:,} total bytes ...]\n"
+                    f"{_SEP}\n"
+                )
+            
+            # File is small enough, read all
+            content = data.decode('utf-8')
+            logger.info(f"Successfully read file: {filename} ({len(content)} characters)")
+            return f"File: {filename}\n{_SEP}\n{content}\n{_SEP}\n"
+                    
+        except UnicodeDecodeError:
+            # If it's a binary file, just note that
+            logger.warning(f"File {filename} appears to be binary, skipping content reading")
+            return f"File: {filename}\n{_SEP}\n[Binary file - content not displayed]\n{_SEP}\n"
+        except Exception as e:
+            logger.error(f"Error reading file {file_path}: {str(e)}")
+            return f"File: {filename}\n{_SEP}\n[Error reading file: {str(e)}]\n{_SEP}\n"
        
     def create_llm(self, provider: str, **kwargs):
-        """Factory function to create different LLM instances"""
-        from langchain_openai import ChatOpenAI
-        from langchain_anthropic import ChatAnthropic
-        from langchain_community.chat_models import ChatOllama
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        from langchain_mistralai import ChatMistralAI
-        
-        if provider.lower() == "openai":
-            return ChatOpenAI(
-                base_url="https://api.together.xyz/v1",
-                model=kwargs.get("model", "gpt-4"),
-                api_key=kwargs.get("api_key"),
-                temperature=kwargs.get("temperature", 0.7)
-            )
-        
-        elif provider.lower() == "anthropic":
-            return ChatAnthropic(
-                model=kwargs.get("model", "claude-sonnet-4-20250514"),
-                api_key=kwargs.get("api_key"),
-                temperature=kwargs.get("temperature", 0.7),
-                # Enable prompt caching support
-                default_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
-                max_tokens=kwargs.get("max_tokens", 8192)  # increased as generating html repotrts need a lot of tokens
-            )
-        
-        elif provider.lower() == "ollama":
-            return ChatOllama(
-                model=kwargs.get("model", "llama2"),
-                base_url=kwargs.get("base_url", "http://localhost:11434"),
-                temperature=kwargs.get("temperature", 0.7)
-            )
-        
-        elif provider.lower() == "google":
-            return ChatGoogleGenerativeAI(
-                model=kwargs.get("model", "gemini-2.5-flash-lite-preview-06-17"),
-                google_api_key=kwargs.get("api_key"),
-                temperature=kwargs.get("temperature", 0.7)
-            )
-        
-        elif provider.lower() == "mistral":
-            return ChatMistralAI(
-                model=kwargs.get("model", "mistral-medium"),
-                mistral_api_key=kwargs.get("api_key"),
-                temperature=kwargs.get("temperature", 0.7)
-            )
-        
-        else:
+        """Factory function to create different LLM instances (only the chosen provider is imported)"""
+        builder = _LLM_PROVIDERS.get(provider.lower())
+        if builder is None:
             raise ValueError(f"Unsupported provider: {provider}")
+        return builder(**kwargs)
         
     async def handle_user_message(self, agent, messages, user_input, task_context):
         """Handle a single user message and stream the response"""
         messages.append({"role": "user", "content": user_input})
         
         response_content = ""
+        # Length of response_content already streamed, so each chunk only slices its new suffix
+        offset = 0
         async for chunk in agent.astream({"messages": messages}):
             if "agent" in chunk:
+                message_content = chunk["agent"]["messages"][0].content
                 # Handle string content
-                if isinstance(chunk["agent"]["messages"][0].content, str):
-                    content = chunk["agent"]["messages"][0].content
-                    new_content = content[len(response_content):]
-                    response_content = content
+                if isinstance(message_content, str):
+                    response_content = message_content
+                    offset = len(message_content)
                     
                 # Handle list content (tool calls)
-                if isinstance(chunk["agent"]["messages"][0].content, list):
-                    for part in chunk["agent"]["messages"][0].content:
+                if isinstance(message_content, list):
+                    for part in message_content:
                         if "text" in part:
                             content = part["text"]
-                            new_content = content[len(response_content):]
-                            task_context.append_intermediate_output(f"{new_content}")
+                            task_context.append_intermediate_output(content[offset:])
                             response_content = content
+                            offset = len(content)
                         if "name" in part and part["name"]:
                             tool_name = part["name"]
                             task_context.append_intermediate_output(f"\n**Calling tool:** `{tool_name}`")
@@ -703,13 +1108,13 @@ Use this information along with the Incorta MCP tools to answer the user's quest
     
     def _markdown_to_html(self, markdown_text):
         """Convert Markdown text to HTML"""
+        markdown = _get_markdown()
+        if markdown is None:
+            logger.warning("markdown package not available, returning plain text")
+            return markdown_text
         try:
-            import markdown
             html = markdown.markdown(markdown_text, extensions=['extra', 'nl2br', 'sane_lists'])
             return html
-        except ImportError:
-            logger.warning("markdown package not available, returning plain text")
-            return markdown_text
         except Exception as e:
             logger.error(f"Error converting markdown to HTML: {e}")
             return markdown_text
@@ -717,7 +1122,7 @@ Use this information along with the Incorta MCP tools to answer the user's quest
     def _format_tool_args(self, args):
         """Format tool arguments for display"""
         if isinstance(args, dict):
-            if len(str(args)) > 100:
+            if _repr_exceeds(args, 100):
                 # Truncate long args
                 return f"`{list(args.keys())}`"
             return f"`{args}`"
@@ -726,18 +1131,23 @@ Use this information along with the Incorta MCP tools to answer the user's quest
     def _format_tool_result(self, result):
         """Format tool results for better readability"""
         try:
-            # Try to parse as JSON for pretty formatting
             if isinstance(result, str):
-                try:
-                    parsed = json.loads(result)
-                    # Format as code block
-                    return f"```json\n{json.dumps(parsed, indent=2)}\n```"
-                except:
-                    # Not JSON, check if it's long text
-                    if len(result) > 500:
-                        # Truncate very long results
-                        return f"```\n{result[:500]}...\n[Result truncated - {len(result)} total characters]\n```"
-                    return f"```\n{result}\n```"
+                if len(result) > _TOOL_RESULT_PREVIEW_CHARS:
+                    # Truncate very long results as-is; pretty-printing them would
+                    # parse and re-serialize the whole payload just to cut it
+                    return f"```\n{result[:_TOOL_RESULT_PREVIEW_CHARS]}...\n[Result truncated - {len(result)} total characters]\n```"
+                # Only objects/arrays are worth pretty-printing; peeking at the first character
+                # avoids raising (and catching) a JSONDecodeError for every plain-text result
+                if result.lstrip()[:1] in ("{", "["):
+                    try:
+                        # Try to parse as JSON for pretty formatting
+                        parsed = json.loads(result)
+                        # Format as code block
+                        return f"```json\n{json.dumps(parsed, indent=2)}\n```"
+                    except ValueError:
+                        pass
+                # Not JSON, show as plain text
+                return f"```\n{result}\n```"
             else:
                 # Already an object, format it
                 return f"```json\n{json.dumps(result, indent=2)}\n```"
@@ -753,33 +1163,38 @@ Use this information along with the Incorta MCP tools to answer the user's quest
         This looks for HTML code wrapped in ```html blocks in the LLM response.
         If found, it validates that it's a complete HTML document (has <html>, <head>, <body>).
         """
-        import re
+        # Fast path for the common case: no code fence at all (or no text to scan)
+        if not isinstance(text, str) or "```" not in text:
+            logger.info("No HTML code blocks found in response")
+            return ""
         
-        # Pattern to match ```html code blocks
-        html_pattern = r'```html\s*\n(.*?)\n```'
-        matches = re.findall(html_pattern, text, re.DOTALL | re.IGNORECASE)
+        block = _find_html_block(text)
         
-        if not matches:
+        if block is None:
             logger.info("No HTML code blocks found in response")
             return ""
         
         # Take the first HTML block found
-        html_content = matches[0].strip()
-        logger.info(f"Found HTML block with {len(html_content)} characters")
+        html_content = text[block[1]:block[2]].strip()
+        logger.info("Found HTML block with %d characters", len(html_content))
+        
+        # Lowercase once and reuse it for every tag check below
+        lowered = html_content.lower()
         
         # Check if it ends properly (has closing tags)
-        has_closing_html = '</html>' in html_content.lower()
-        has_closing_body = '</body>' in html_content.lower()
-        has_closing_script = '</script>' in html_content.lower()
+        has_closing_html = '</html>' in lowered
+        has_closing_body = '</body>' in lowered
+        has_closing_script = '</script>' in lowered
         
         if not has_closing_html or not has_closing_body:
-            logger.warning(f"HTML appears truncated! has_closing_html={has_closing_html}, has_closing_body={has_closing_body}, has_closing_script={has_closing_script}")
-            logger.warning(f"Last 200 characters: {html_content[-200:]}")
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("HTML appears truncated! has_closing_html=%s, has_closing_body=%s, has_closing_script=%s", has_closing_html, has_closing_body, has_closing_script)
+                logger.warning("Last 200 characters: %s", html_content[-200:])
             return ""
         
         # Validate it's a complete HTML document
         # Must have <html>, <head>, and <body> tags to be considered complete
-        if not all(tag in html_content.lower() for tag in ['<html', '<head', '<body']):
+        if not all(tag in lowered for tag in ('<html', '<head', '<body')):
             logger.info("HTML block found but not a complete document, skipping")
             return ""
         
@@ -789,104 +1204,154 @@ Use this information along with the Incorta MCP tools to answer the user's quest
     def remove_html_blocks(self, text: str) -> str:
         """
         here we will remove the html code from the markdown text, to not show it in the response of operator 1... but save it to pass to operator 2
+        
+        Newlines are only normalized where a block was removed: the newline runs on both
+        sides of each splice point are merged into at most one blank line ("\n\n").
         """
-        import re
+        # Remove all HTML code blocks, keeping the text between them
+        pieces = []
+        pos = 0
+        block = _find_html_block(text)
+        while block is not None:
+            pieces.append(text[pos:block[0]])
+            pos = block[3]
+            block = _find_html_block(text, pos)
+        pieces.append(text[pos:])
         
-    
-        html_pattern = r'```html\s*\n.*?\n```'
-        # Remove all HTML code blocks
-        cleaned_text = re.sub(html_pattern, '', text, flags=re.DOTALL | re.IGNORECASE)
-        cleaned_text = re.sub(r'\n{3,}', '\n\n', cleaned_text)
+        out = []
+        last = len(pieces) - 1
+        run = 0  # newlines collected at the current splice point
+        for i, piece in enumerate(pieces):
+            if i:
+                core = piece.lstrip("\n")
+                run += len(piece) - len(core)
+                if not core and i < last:
+                    # Only newlines between two blocks: the run continues to the next splice
+                    continue
+                out.append("\n" * min(run, 2))
+                piece = core
+            if i < last:
+                core = piece.rstrip("\n")
+                run = len(piece) - len(core)
+                piece = core
+            out.append(piece)
         
-        return cleaned_text.strip()
+        return "".join(out).strip()
+
+
+def _normalize_package_name(name: str) -> str:
+    """Normalize a distribution name for comparison (PEP 503: case, '-', '_' and '.' are equivalent)."""
+    return _PACKAGE_NAME_SEP_RE.sub("-", name).lower()
 
 
-def get_installed_version(package_name: str) -> Optional[str]:
-    """Return the installed version of a package, or None if not installed."""
+def _installed_versions() -> dict:
+    """Return {normalized distribution name: version} for every installed package, read in-process once."""
+    versions = {}
+    for dist in importlib.metadata.distributions():
+        name = dist.metadata["Name"]
+        if name:
+            versions.setdefault(_normalize_package_name(name), dist.version)
+    return versions
+
+
+def _pip_install(packages) -> bool:
+    """Install or upgrade the given requirements with a single pip invocation. Returns True on success."""
+    # Stream pip's output line by line instead of buffering it all in memory; only the
+    # last _PIP_LOG_TAIL_LINES are kept so they can be reported if the install fails
+    tail = deque(maxlen=_PIP_LOG_TAIL_LINES)
     try:
-        result = subprocess.run(
-            [sys.executable, "-m", "pip", "show", package_name],
+        with subprocess.Popen(
+            [sys.executable, "-m", "pip", "install", "--upgrade", *packages],
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             text=True
-        )
-        if result.returncode != 0:
-            return None
+        ) as process:
+            for line in process.stdout:
+                line = line.rstrip()
+                logger.debug("pip: %s", line)
+                tail.append(line)
+            returncode = process.wait()
+    except Exception as e:
+        logger.error(f"💥 Exception while installing {packages}: {e}")
+        return False
 
-        for line in result.stdout.splitlines():
-            if line.startswith("Version:"):
-                return line.split("Version:")[1].strip()
-        return None
-    except Exception:
-        return None
+    if returncode != 0:
+        logger.error(f"❌ Failed to install {packages}")
+        logger.error("--- pip output (last lines) ---\n" + "\n".join(tail))
+        return False
 
+    logger.info(f"✅ Successfully installed {packages}")
+    return True
 
-def install_or_upgrade_packages():
-    """Install or upgrade required packages for the MCP plugin."""
-    packages = [
-        "mcp",
-        "anthropic",
-        "langchain-core==0.3.75",
-        "langchain==0.3.27",
-        "langchain-anthropic==0.3.19",
-        "langchain-mistralai==0.2.11",
-        "langchain-openai==0.3.32",
-        "langchain-community==0.3.29",
-        "langchain-google-genai==2.1.10",
-        "langgraph==0.2.60",
-        "langchain-mcp-adapters==0.1.9",
-        "markdown",
-    ]
-
-    for package in packages:
-        # Split out version if pinned
-        if "==" in package:
-            package_name, required_version = package.split("==")
-        else:
-            package_name, required_version = package, None
 
-        installed_version = get_installed_version(package_name)
+def _ensure_deps() -> bool:
+    """
+    Make sure every required package is installed at its pinned version.
 
-        # Determine whether to skip or upgrade
-        if installed_version:
-            if required_version and installed_version == required_version:
-                logger.info(
-                    f"{package_name} already at required version ({installed_version}), skipping..."
-                )
-                continue
-            else:
-                logger.info(
-                    f"{package_name} is installed (version {installed_version}), upgrading to {required_version or 'latest'}..."
-                )
-        else:
-            logger.info(f"{package_name} not installed, installing {required_version or 'latest'}...")
+    The sentinel file records the requirement list that was last satisfied; while it
+    matches and every module is still importable, the version check is skipped, so a
+    restarted process does not start pip at all. A missing module (e.g. a rebuilt
+    environment) or a changed requirement list falls through to the full check, which
+    installs only the requirements that are missing or pinned to a different version,
+    in a single pip run.
+    Returns True once all dependencies are available.
+    """
+    signature = "\n".join(requirement for requirement, _ in _REQUIRED_PACKAGES)
+    try:
+        with open(_DEPS_SENTINEL, "r", encoding="utf-8") as f:
+            sentinel = f.read()
+    except OSError:
+        sentinel = None
+    if sentinel == signature and all(
+        importlib.util.find_spec(module) is not None for _, module in _REQUIRED_PACKAGES
+    ):
+        _log_installed_versions()
+        return True
 
-        try:
-            result = subprocess.run(
-                [sys.executable, "-m", "pip", "install", "--upgrade", package],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+    # One metadata snapshot instead of a `pip show` subprocess per package
+    installed_versions = _installed_versions()
+    to_install = []
+
+    for requirement, _ in _REQUIRED_PACKAGES:
+        package_name, _, required_version = requirement.partition("==")
+        installed_version = installed_versions.get(_normalize_package_name(package_name))
+
+        if installed_version is None:
+            logger.info(f"{package_name} not installed, installing {required_version or 'latest'}...")
+        elif required_version and installed_version != required_version:
+            logger.info(
+                f"{package_name} is installed (version {installed_version}), switching to {required_version}..."
             )
+        else:
+            continue
 
-            if result.returncode == 0:
-                logger.info(f"✅ Successfully installed/upgraded {package}")
-            else:
-                logger.error(f"❌ Failed to install/upgrade {package}")
-                logger.error(f"--- stdout ---\n{result.stdout}")
-                logger.error(f"--- stderr ---\n{result.stderr}")
+        to_install.append(requirement)
 
-        except Exception as e:
-            logger.error(f"💥 Exception while installing/upgrading {package}: {e}")
+    # Install everything in one pip run so the resolver plans all packages together
+    if to_install:
+        if not _pip_install(to_install):
+            return False
+        importlib.invalidate_caches()
 
-    # Optional: Show final versionsa
+    # Only record the sentinel once every requirement is known to be satisfied
     try:
-        result = subprocess.run(
-            [sys.executable, "-m", "pip", "freeze"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        with open(_DEPS_SENTINEL, "w", encoding="utf-8") as f:
+            f.write(signature)
+    except OSError as e:
+        logger.warning(f"Could not write dependency sentinel {_DEPS_SENTINEL}: {e}")
+
+    _log_installed_versions()
+    return True
+
+
+def _log_installed_versions():
+    """Log every installed package version (diagnostic only, enable with MCP_PLUGIN_DEBUG=1)."""
+    if not os.getenv("MCP_PLUGIN_DEBUG"):
+        return
+    try:
+        listing = "\n".join(
+            f"{name}=={version}" for name, version in sorted(_installed_versions().items())
         )
-        logger.info("--- Installed package versions ---\n" + result.stdout)
+        logger.info("--- Installed package versions ---\n" + listing)
     except Exception as e:
         logger.error(f"Failed to list installed packages: {e}")